@@ -1,248 +1,481 @@
+import asyncio
+import atexit
 import sqlite3
+import aiosqlite
 import csv
+import html
+import io
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import time
+from contextlib import asynccontextmanager
 from pathlib import Path
 from datetime import datetime, timedelta
+try:
+    # google-re2 gives linear-time matching; used only for callback routing
+    import re2 as _route_re
+except ImportError:
+    import re as _route_re
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     ContextTypes, MessageHandler, filters
 )
 from telegram.request import HTTPXRequest
-
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from aiosqlitepool import SQLiteConnectionPool
+
+# Set up logging; handlers only enqueue records and a listener thread does the
+# actual writing, so logging never blocks the event loop on I/O
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+LOG_LISTENER = logging.handlers.QueueListener(_log_queue, _log_output)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 # === CERULEAN LABS BOT CONFIG ===
 TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = [6454727490]  # <-- Replace with your Telegram user ID from @userinfobot
+ADMIN_IDS = frozenset({6454727490})  # <-- Replace with your Telegram user ID from @userinfobot
 X_LINK = "https://x.com/ceruleanlabs"
 TELEGRAM_LINK = "https://t.me/ceruleanlabsgroupchat"
 GROUP_CHAT_ID = -1002664797681  # <-- Add your group chat ID here (e.g., -1001234567890) - Optional
 
 POINTS_PER_REFERRAL = 1
 ENGAGEMENT_POINTS_PER_MESSAGE = 1
+DEFAULT_BOT_USERNAME = "ceruleanlabsbot"
+ENGAGEMENT_FLUSH_INTERVAL = 10  # seconds between engagement buffer flushes
+LEADERBOARD_REFRESH_INTERVAL = 60  # seconds between leaderboard cache rebuilds
+EXPORT_BATCH_SIZE = 1000  # rows fetched per round-trip when exporting CSVs
+
+# Group message counts waiting to be written, keyed by (user_id, week)
+ENG_BUFFER: dict[tuple[int, str], tuple[str, int]] = {}
+ENG_LOCK = asyncio.Lock()
+
+# Rendered archive detail text by week; archived weeks only change on reset
+ARCHIVE_TEXT_CACHE: dict[str, str] = {}
+# Archived-weeks picker, rebuilt only after the set of archived weeks changes
+ARCHIVE_KB_CACHE = None
 
 # --- Database Setup ---
-def init_database():
-    """Initialize database with proper error handling"""
+DB_PATH = Path.home() / "referrals.db"
+
+# Applied once per pooled connection; they stay in effect for its lifetime
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
+
+# SQLite allows a single writer at a time, so writes share one connection
+# while reads fan out over read-only connections (WAL lets them run concurrently)
+READ_POOL_SIZE = os.cpu_count() or 4
+READ_POOL = None
+WRITE_POOL = None
+
+async def connect_database(read_only=False):
+    """Open a tuned SQLite connection for the pool"""
+    # timeout sets the busy handler: how long a locked database is waited on
+    db = await aiosqlite.connect(str(DB_PATH), timeout=30.0, cached_statements=256)
+    for pragma in SQLITE_PRAGMAS:
+        await db.execute(pragma)
+    if read_only:
+        await db.execute("PRAGMA query_only=true")
+    return db
+
+@asynccontextmanager
+async def read():
+    """Borrow a read-only connection"""
+    async with READ_POOL.connection() as db:
+        yield db
+
+@asynccontextmanager
+async def write():
+    """Borrow the single writer connection"""
+    async with WRITE_POOL.connection() as db:
+        yield db
+
+async def init_database():
+    """Create the connection pools and initialize the schema"""
+    global READ_POOL, WRITE_POOL
     try:
-        db_path = Path.home() / "referrals.db"
-        conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30.0)
-        cur = conn.cursor()
-        
-        # Ambassadors table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ambassadors (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            points INTEGER DEFAULT 0
+        WRITE_POOL = SQLiteConnectionPool(connect_database, pool_size=1)
+        READ_POOL = SQLiteConnectionPool(
+            lambda: connect_database(read_only=True), pool_size=READ_POOL_SIZE
         )
-        """)
+
+        async with write() as c:
+            # Ambassadors table
+            await c.execute("""
+            CREATE TABLE IF NOT EXISTS ambassadors (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                points INTEGER DEFAULT 0
+            )
+            """)
         
-        # Users table (for ambassador referrals)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            referrer INTEGER,
-            status TEXT DEFAULT 'pending'
-        )
-        """)
+            # Users table (for ambassador referrals)
+            await c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                referrer INTEGER,
+                status TEXT DEFAULT 'pending'
+            )
+            """)
         
-        # Regular referrals table (separate from ambassador program)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS referrals (
-            user_id INTEGER PRIMARY KEY,
-            referrer_id INTEGER,
-            username TEXT,
-            status TEXT DEFAULT 'pending',
-            completed_at TIMESTAMP,
-            period TEXT
-        )
-        """)
+            # Regular referrals table (separate from ambassador program)
+            await c.execute("""
+            CREATE TABLE IF NOT EXISTS referrals (
+                user_id INTEGER PRIMARY KEY,
+                referrer_id INTEGER,
+                username TEXT,
+                status TEXT DEFAULT 'pending',
+                completed_at TIMESTAMP,
+                period TEXT
+            )
+            """)
         
-        # Engagement tracking table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS engagement (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            username TEXT,
-            message_count INTEGER DEFAULT 0,
-            last_message_at TIMESTAMP,
-            period TEXT,
-            UNIQUE(user_id, period)
-        )
-        """)
+            # Engagement tracking table
+            await c.execute("""
+            CREATE TABLE IF NOT EXISTS engagement (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                username TEXT,
+                message_count INTEGER DEFAULT 0,
+                last_message_at TIMESTAMP,
+                period TEXT,
+                UNIQUE(user_id, period)
+            )
+            """)
         
-        # Weekly/Monthly winners table
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS winners (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category TEXT,
-            period TEXT,
-            user_id INTEGER,
-            username TEXT,
-            count INTEGER,
-            reward TEXT,
-            awarded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+            # Weekly/Monthly winners table
+            await c.execute("""
+            CREATE TABLE IF NOT EXISTS winners (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category TEXT,
+                period TEXT,
+                user_id INTEGER,
+                username TEXT,
+                count INTEGER,
+                reward TEXT,
+                awarded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
         
-        # Add missing columns to existing tables
-        try:
-            cur.execute("ALTER TABLE users ADD COLUMN joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            logger.info("Added joined_at column to users table")
-        except sqlite3.OperationalError:
-            pass
+            # Precomputed top-10 rows served by the leaderboard handlers
+            await c.execute("""
+            CREATE TABLE IF NOT EXISTS leaderboard_cache (
+                category TEXT,
+                period TEXT,
+                rank INTEGER,
+                username TEXT,
+                count INTEGER,
+                PRIMARY KEY (category, period, rank)
+            )
+            """)
         
-        try:
-            cur.execute("ALTER TABLE ambassadors ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            logger.info("Added created_at column to ambassadors table")
-        except sqlite3.OperationalError:
-            pass
+            # Add missing columns to existing tables
+            try:
+                await c.execute("ALTER TABLE users ADD COLUMN joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+                logger.info("Added joined_at column to users table")
+            except sqlite3.OperationalError:
+                pass
+        
+            try:
+                await c.execute("ALTER TABLE ambassadors ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+                logger.info("Added created_at column to ambassadors table")
+            except sqlite3.OperationalError:
+                pass
         
-        conn.commit()
+            # Indexes for the per-user lookups and leaderboard aggregations
+            await c.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer_status ON users(referrer, status)")
+            await c.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer_period_status ON referrals(referrer_id, period, status)")
+            await c.execute("CREATE INDEX IF NOT EXISTS idx_referrals_period_status ON referrals(period, status)")
+            await c.execute("CREATE INDEX IF NOT EXISTS idx_engagement_period_count ON engagement(period, message_count DESC)")
+            await c.execute("CREATE INDEX IF NOT EXISTS idx_ambassadors_points ON ambassadors(points DESC)")
+            await c.execute("CREATE INDEX IF NOT EXISTS idx_winners_cat_period_count ON winners(category, period, count DESC, username)")
+        
+            await c.commit()
+
+            # Refresh planner statistics so the new indexes get picked up
+            await c.execute("ANALYZE")
+
         logger.info("Database initialized successfully")
-        return conn, cur
         
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
         raise
 
-# Initialize database
-conn, cur = init_database()
+async def close_database():
+    """Close all pooled connections"""
+    for pool in (READ_POOL, WRITE_POOL):
+        if pool is not None:
+            await pool.close()
+
+# --- Hot-path SQL ---
+# sqlite3 caches compiled statements per connection keyed by SQL text, so the
+# per-message and per-click queries live here to be reused verbatim
+SQL_AMBASSADOR_USERNAME = "SELECT username FROM ambassadors WHERE user_id=?"
+SQL_USER_REFERRAL = "SELECT referrer, status FROM users WHERE user_id=?"
+SQL_INSERT_USER = """
+    INSERT INTO users (user_id, referrer, status) VALUES (?, ?, 'pending')
+    ON CONFLICT(user_id) DO NOTHING
+"""
+SQL_COMPLETE_USER = """
+    UPDATE users SET status='completed'
+    WHERE user_id=? AND referrer=? AND status IS NOT 'completed'
+    RETURNING referrer
+"""
+SQL_INSERT_AMBASSADOR = """
+    INSERT INTO ambassadors (user_id, username, points) VALUES (?, ?, 0)
+    ON CONFLICT(user_id) DO NOTHING
+"""
+SQL_ADD_AMBASSADOR_POINTS = "UPDATE ambassadors SET points = points + ? WHERE user_id=?"
+SQL_REFERRAL_USERNAME = "SELECT username FROM referrals WHERE user_id=?"
+SQL_REFERRAL_STATUS = "SELECT status FROM referrals WHERE user_id=? AND period=?"
+SQL_UPSERT_REFERRAL = """
+    INSERT INTO referrals (user_id, referrer_id, username, status, period) 
+    VALUES (?, ?, ?, 'pending', ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        referrer_id = excluded.referrer_id,
+        username = excluded.username,
+        status = excluded.status,
+        completed_at = NULL,
+        period = excluded.period
+    WHERE referrals.period IS NOT excluded.period
+"""
+SQL_COMPLETE_REFERRAL = """
+    UPDATE referrals SET status='completed', completed_at=CURRENT_TIMESTAMP 
+    WHERE user_id=? AND period=? AND status IS NOT 'completed'
+    RETURNING 1
+"""
+SQL_CACHED_LEADERBOARD = """
+    SELECT username, count FROM leaderboard_cache
+    WHERE category=? AND period=?
+    ORDER BY rank
+    LIMIT 10
+"""
+SQL_UPSERT_ENGAGEMENT = """
+    INSERT INTO engagement (user_id, username, message_count, last_message_at, period)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?)
+    ON CONFLICT(user_id, period) DO UPDATE SET
+        message_count = message_count + excluded.message_count,
+        last_message_at = CURRENT_TIMESTAMP,
+        username = excluded.username
+"""
+
+# Admin and archive statements
+SQL_ARCHIVE_WEEK = """
+    INSERT INTO winners (category, period, user_id, username, count, reward)
+    SELECT 'engagement', period, user_id, username, message_count, 'Archived'
+    FROM engagement
+    WHERE period=?
+"""
+SQL_DELETE_WEEK = "DELETE FROM engagement WHERE period=?"
+SQL_ARCHIVED_WEEKS = """
+    SELECT DISTINCT period
+    FROM winners
+    WHERE category='engagement'
+    ORDER BY period DESC
+"""
+SQL_ARCHIVE_DETAIL = """
+    SELECT username, count
+    FROM winners
+    WHERE category='engagement' AND period=?
+    ORDER BY count DESC
+    LIMIT 10
+"""
+# One script so a full reset is a single atomic transaction
+SQL_RESET_ALL = """
+    BEGIN;
+    DELETE FROM users;
+    DELETE FROM ambassadors;
+    DELETE FROM referrals;
+    DELETE FROM engagement;
+    DELETE FROM winners;
+    COMMIT;
+"""
+
+def get_bot_username(context: ContextTypes.DEFAULT_TYPE):
+    """Get the bot username cached at startup"""
+    return context.bot_data.get("bot_username", DEFAULT_BOT_USERNAME)
+
+# (expires_at, week, month); both identifiers can only change at midnight
+_PERIOD_CACHE = (0.0, "", "")
 
 def get_current_period():
-    """Get current week/month identifier"""
+    """Get current week/month identifier, cached until the next local midnight"""
+    global _PERIOD_CACHE
+    expires_at, week, month = _PERIOD_CACHE
+    if time.time() < expires_at:
+        return week, month
+
     now = datetime.now()
     week = f"{now.year}-W{now.isocalendar()[1]:02d}"
     month = f"{now.year}-M{now.month:02d}"
+    next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    _PERIOD_CACHE = (next_midnight.timestamp(), week, month)
     return week, month
 
+MEDALS = ("🥇", "🥈", "🥉")
+
+def format_ranking(rows, unit: str):
+    """Render ranked (username, count) rows, one line each"""
+    return "".join(
+        f"{MEDALS[i] if i < 3 else f'{i + 1}.'} @{username} - {count} {unit}\n"
+        for i, (username, count) in enumerate(rows)
+    )
+
+# --- Keyboards ---
+# Static keyboards are built once at import; only the task keyboards carry
+# per-referrer callback data
+MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👑 Become Ambassador", callback_data="become_amb")],
+    [InlineKeyboardButton("🔗 Get Referral Link", callback_data="get_ref")],
+    [InlineKeyboardButton("📊 My Stats", callback_data="my_stats")],
+    [InlineKeyboardButton("🏆 Leaderboards", callback_data="leaderboards")]
+])
+
+LEADERBOARDS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👑 Ambassador Leaderboard", callback_data="lb_amb")],
+    [InlineKeyboardButton("🎁 Referral Contest (Monthly)", callback_data="lb_ref")],
+    [InlineKeyboardButton("💬 Engagement (Weekly)", callback_data="lb_eng")]
+])
+
+RESET_CONFIRM_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚠️ Yes, Reset All Data", callback_data="confirm_reset")],
+    [InlineKeyboardButton("❌ Cancel", callback_data="cancel_reset")]
+])
+
+JOIN_TELEGRAM_BUTTON = InlineKeyboardButton("📱 Join Telegram", url=TELEGRAM_LINK)
+FOLLOW_X_BUTTON = InlineKeyboardButton("🐦 Follow on X", url=X_LINK)
+
+STATS_HEADER = "📊 <b>Your Statistics</b>\n\n"
+
+def ambassador_tasks_keyboard(referrer_id: int):
+    """Task keyboard for an ambassador referral"""
+    return InlineKeyboardMarkup([
+        [JOIN_TELEGRAM_BUTTON],
+        [FOLLOW_X_BUTTON],
+        [InlineKeyboardButton("✅ Done!", callback_data=f"amb_done_{referrer_id}")]
+    ])
+
+def referral_tasks_keyboard(referrer_id: int):
+    """Task keyboard for a referral contest invite"""
+    return InlineKeyboardMarkup([
+        [JOIN_TELEGRAM_BUTTON],
+        [FOLLOW_X_BUTTON],
+        [InlineKeyboardButton("✅ Done!", callback_data=f"ref_done_{referrer_id}")]
+    ])
+
 # --- AMBASSADOR PROGRAM HANDLERS ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
-    try:
-        user_id = update.effective_user.id
-        username = update.effective_user.username or f"User{user_id}"
-        args = context.args
-
-        # Case 1: Ambassador referral link
-        if args and args[0].startswith("amb_"):
-            referrer_id = int(args[0].replace("amb_", ""))
-            cur.execute("SELECT username FROM ambassadors WHERE user_id=?", (referrer_id,))
-            referrer_info = cur.fetchone()
+    user_id = update.effective_user.id
+    username = update.effective_user.username or f"User{user_id}"
+    args = context.args
+
+    # Case 1: Ambassador referral link
+    if args and args[0].startswith("amb_"):
+        referrer_id = int(args[0].replace("amb_", ""))
+        async with read() as c:
+            referrer_info = await (await c.execute(SQL_AMBASSADOR_USERNAME, (referrer_id,))).fetchone()
             
-            if not referrer_info:
-                await update.message.reply_text("❌ Invalid ambassador referral link.")
-                return
+        if not referrer_info:
+            await update.message.reply_text("❌ Invalid ambassador referral link.")
+            return
 
-            if referrer_id == user_id:
-                await update.message.reply_text("⚠️ You cannot use your own referral link!")
-                return
+        if referrer_id == user_id:
+            await update.message.reply_text("⚠️ You cannot use your own referral link!")
+            return
 
-            cur.execute("SELECT referrer, status FROM users WHERE user_id=?", (user_id,))
-            existing = cur.fetchone()
+        # Insert and existence check in one statement; only look the row
+        # up when the user was already registered
+        async with write() as c:
+            inserted = (await c.execute(SQL_INSERT_USER, (user_id, referrer_id))).rowcount > 0
+            if inserted:
+                await c.commit()
+            else:
+                existing = await (await c.execute(SQL_USER_REFERRAL, (user_id,))).fetchone()
 
-            if existing:
-                if existing[1] == "completed":
-                    await update.message.reply_text("✅ You've already completed ambassador tasks!")
-                else:
-                    await show_ambassador_tasks(update, context, referrer_id, referrer_info[0])
-                return
+        if not inserted:
+            if existing[1] == "completed":
+                await update.message.reply_text("✅ You've already completed ambassador tasks!")
+            else:
+                await show_ambassador_tasks(update, context, referrer_id, referrer_info[0])
+            return
 
-            cur.execute("INSERT INTO users (user_id, referrer, status) VALUES (?, ?, ?)",
-                        (user_id, referrer_id, "pending"))
-            conn.commit()
-            logger.info(f"New user {user_id} referred by ambassador {referrer_id}")
-            await show_ambassador_tasks(update, context, referrer_id, referrer_info[0])
+        logger.info(f"New user {user_id} referred by ambassador {referrer_id}")
+        await show_ambassador_tasks(update, context, referrer_id, referrer_info[0])
 
-        # Case 2: Regular referral link
-        elif args and args[0].startswith("ref_"):
-            referrer_id = int(args[0].replace("ref_", ""))
+    # Case 2: Regular referral link
+    elif args and args[0].startswith("ref_"):
+        referrer_id = int(args[0].replace("ref_", ""))
             
-            if referrer_id == user_id:
-                await update.message.reply_text("⚠️ You cannot use your own referral link!")
-                return
-
-            cur.execute("SELECT username FROM referrals WHERE user_id=?", (referrer_id,))
-            referrer_info = cur.fetchone()
-            referrer_username = referrer_info[0] if referrer_info else "Unknown"
-
-            week, month = get_current_period()
-            cur.execute("SELECT status FROM referrals WHERE user_id=? AND period=?", (user_id, month))
-            existing = cur.fetchone()
+        if referrer_id == user_id:
+            await update.message.reply_text("⚠️ You cannot use your own referral link!")
+            return
 
-            if existing:
-                if existing[0] == "completed":
-                    await update.message.reply_text("✅ You've already completed referral tasks this month!")
-                else:
-                    await show_referral_tasks(update, context, referrer_id, referrer_username)
-                return
+        week, month = get_current_period()
+        async with read() as c:
+            referrer_info = await (await c.execute(SQL_REFERRAL_USERNAME, (referrer_id,))).fetchone()
+        referrer_username = referrer_info[0] if referrer_info else "Unknown"
+
+        # Only writes when the user has no referral row for this month
+        async with write() as c:
+            inserted = (await c.execute(
+                SQL_UPSERT_REFERRAL, (user_id, referrer_id, username, month)
+            )).rowcount > 0
+            if inserted:
+                await c.commit()
+            else:
+                existing = await (await c.execute(SQL_REFERRAL_STATUS, (user_id, month))).fetchone()
 
-            cur.execute("""
-                INSERT OR REPLACE INTO referrals (user_id, referrer_id, username, status, period) 
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, referrer_id, username, "pending", month))
-            conn.commit()
-            logger.info(f"New referral user {user_id} referred by {referrer_id}")
-            await show_referral_tasks(update, context, referrer_id, referrer_username)
+        if not inserted:
+            if existing[0] == "completed":
+                await update.message.reply_text("✅ You've already completed referral tasks this month!")
+            else:
+                await show_referral_tasks(update, context, referrer_id, referrer_username)
+            return
 
-        # Case 3: No referral link
-        else:
-            keyboard = [
-                [InlineKeyboardButton("👑 Become Ambassador", callback_data="become_amb")],
-                [InlineKeyboardButton("🔗 Get Referral Link", callback_data="get_ref")],
-                [InlineKeyboardButton("📊 My Stats", callback_data="my_stats")],
-                [InlineKeyboardButton("🏆 Leaderboards", callback_data="leaderboards")]
-            ]
-            await update.message.reply_text(
-                "🌟 **Welcome to Cerulean Labs!**\n\n"
-                "Choose an option below:\n\n"
-                "👑 **Ambassador Program**: Earn points for referrals\n"
-                "🎯 **Referral Contest**: Win weekly/monthly rewards\n"
-                "💬 **Engagement Rewards**: Active group members get rewarded\n\n"
-                "Select an option to get started!",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown"
-            )
+        logger.info(f"New referral user {user_id} referred by {referrer_id}")
+        await show_referral_tasks(update, context, referrer_id, referrer_username)
 
-    except Exception as e:
-        logger.error(f"Error in start: {e}")
-        try:
-            await update.message.reply_text("❌ An error occurred. Please try again.")
-        except:
-            pass
+    # Case 3: No referral link
+    else:
+        await update.message.reply_text(
+            "🌟 <b>Welcome to Cerulean Labs!</b>\n\n"
+            "Choose an option below:\n\n"
+            "👑 <b>Ambassador Program</b>: Earn points for referrals\n"
+            "🎯 <b>Referral Contest</b>: Win weekly/monthly rewards\n"
+            "💬 <b>Engagement Rewards</b>: Active group members get rewarded\n\n"
+            "Select an option to get started!",
+            reply_markup=MAIN_MENU_KB,
+            parse_mode=ParseMode.HTML
+        )
 
 async def show_ambassador_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, referrer_id: int, referrer_username: str):
     """Show ambassador tasks"""
-    keyboard = [
-        [InlineKeyboardButton("📱 Join Telegram", url=TELEGRAM_LINK)],
-        [InlineKeyboardButton("🐦 Follow on X", url=X_LINK)],
-        [InlineKeyboardButton("✅ Done!", callback_data=f"amb_done_{referrer_id}")]
-    ]
     await update.message.reply_text(
         f"👋 Welcome! You've been invited by @{referrer_username} (Ambassador)!\n\n"
         f"🎯 Complete these tasks:\n"
         f"1️⃣ Join our Telegram channel\n"
         f"2️⃣ Follow us on X\n\n"
         f"Click ✅ when done!",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=ambassador_tasks_keyboard(referrer_id)
     )
 
 async def show_referral_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE, referrer_id: int, referrer_username: str):
     """Show referral contest tasks"""
-    keyboard = [
-        [InlineKeyboardButton("📱 Join Telegram", url=TELEGRAM_LINK)],
-        [InlineKeyboardButton("🐦 Follow on X", url=X_LINK)],
-        [InlineKeyboardButton("✅ Done!", callback_data=f"ref_done_{referrer_id}")]
-    ]
     await update.message.reply_text(
         f"🎁 You've been invited by @{referrer_username}!\n\n"
         f"🎯 Complete these tasks to help them win:\n"
@@ -250,570 +483,524 @@ async def show_referral_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"2️⃣ Follow us on X\n\n"
         f"🏆 Top referrers win rewards weekly/monthly!\n\n"
         f"Click ✅ when done!",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=referral_tasks_keyboard(referrer_id)
     )
 
-async def become_ambassador(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /become_ambassador command"""
-    try:
-        user = update.effective_user
-        user_id = user.id
-        username = user.username or f"id{user_id}"
+async def _become_ambassador_impl(send, user, context: ContextTypes.DEFAULT_TYPE):
+    """Register user as an ambassador and reply through send"""
+    user_id = user.id
+    username = user.username or f"id{user_id}"
 
-        cur.execute("SELECT points FROM ambassadors WHERE user_id=?", (user_id,))
-        existing = cur.fetchone()
+    # The upsert is the existence check, so concurrent taps can't race
+    # between a SELECT and the INSERT
+    async with write() as c:
+        inserted = (await c.execute(SQL_INSERT_AMBASSADOR, (user_id, username))).rowcount > 0
+        await c.commit()
 
-        if existing:
-            await update.message.reply_text(
-                f"👑 You're already an ambassador!\nUse /stats to see your referral link."
-            )
-            return
+    if not inserted:
+        await send(
+            f"👑 You're already an ambassador!\nUse /stats to see your referral link."
+        )
+        return
 
-        cur.execute("INSERT INTO ambassadors (user_id, username, points) VALUES (?, ?, ?)",
-                    (user_id, username, 0))
-        conn.commit()
-        logger.info(f"New ambassador: {username} ({user_id})")
+    logger.info(f"New ambassador: {username} ({user_id})")
 
-        try:
-            bot_info = await context.bot.get_me()
-            bot_username = bot_info.username
-        except:
-            bot_username = "ceruleanlabsbot"
+    bot_username = get_bot_username(context)
             
-        referral_link = f"https://t.me/{bot_username}?start=amb_{user_id}"
+    referral_link = f"https://t.me/{bot_username}?start=amb_{user_id}"
+
+    await send(
+        f"🎉 <b>You're now a Cerulean Labs Ambassador!</b>\n\n"
+        f"🔗 Your referral link:\n<code>{html.escape(referral_link)}</code>\n\n"
+        f"📈 Earn {POINTS_PER_REFERRAL} point per completed referral!\n"
+        f"Use /stats to track your progress!",
+        parse_mode=ParseMode.HTML
+    )
 
-        await update.message.reply_text(
-            f"🎉 **You're now a Cerulean Labs Ambassador!**\n\n"
-            f"🔗 Your referral link:\n`{referral_link}`\n\n"
-            f"📈 Earn {POINTS_PER_REFERRAL} point per completed referral!\n"
-            f"Use /stats to track your progress!",
-            parse_mode="Markdown"
-        )
+async def become_ambassador_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /become_ambassador command"""
+    await _become_ambassador_impl(update.message.reply_text, update.effective_user, context)
 
-    except Exception as e:
-        logger.error(f"Error in become_ambassador: {e}")
-        try:
-            await update.message.reply_text("❌ An error occurred. Please try again.")
-        except:
-            pass
+async def become_ambassador_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Become Ambassador button"""
+    query = update.callback_query
+    await _become_ambassador_impl(query.message.reply_text, query.from_user, context)
 
-async def get_referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _get_referral_link_impl(send, user, context: ContextTypes.DEFAULT_TYPE):
     """Get referral contest link"""
-    try:
-        # Handle both message and callback query
-        if update.callback_query:
-            user = update.callback_query.from_user
-            send_method = update.callback_query.message.reply_text
-        else:
-            user = update.effective_user
-            send_method = update.message.reply_text
-            
-        user_id = user.id
-        username = user.username or f"User{user_id}"
+    user_id = user.id
+    username = user.username or f"User{user_id}"
 
-        week, month = get_current_period()
-        
-        # Check if user already exists in referrals table
-        cur.execute("SELECT user_id FROM referrals WHERE user_id=?", (user_id,))
-        existing = cur.fetchone()
+    week, month = get_current_period()
         
+    # Check if user already exists in referrals table
+    async with write() as c:
+        existing = await (await c.execute(
+            "SELECT user_id FROM referrals WHERE user_id=?", (user_id,)
+        )).fetchone()
+            
         if not existing:
             # Insert new user into referrals table
-            cur.execute("""
+            await c.execute("""
                 INSERT INTO referrals (user_id, username, status, period) 
                 VALUES (?, ?, ?, ?)
             """, (user_id, username, "completed", month))
-            conn.commit()
+            await c.commit()
             logger.info(f"New referral link generated for user {user_id}")
 
-        try:
-            bot_info = await context.bot.get_me()
-            bot_username = bot_info.username
-        except:
-            bot_username = "ceruleanlabsbot"
+    bot_username = get_bot_username(context)
             
-        referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-
-        # Fixed message without problematic markdown
-        message = (
-            "🎁 Your Referral Contest Link\n\n"
-            f"🔗 Link: {referral_link}\n\n"
-            "🏆 This Month's Contest:\n"
-            "Top referrers win exclusive rewards!\n\n"
-            "💡 Share with friends and climb the leaderboard!\n"
-            "Use /referral_leaderboard to see rankings!"
-        )
+    referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
+
+    # Fixed message without problematic markdown
+    message = (
+        "🎁 Your Referral Contest Link\n\n"
+        f"🔗 Link: {referral_link}\n\n"
+        "🏆 This Month's Contest:\n"
+        "Top referrers win exclusive rewards!\n\n"
+        "💡 Share with friends and climb the leaderboard!\n"
+        "Use /referral_leaderboard to see rankings!"
+    )
         
-        await send_method(message)
+    await send(message)
 
-    except Exception as e:
-        logger.error(f"Error in get_referral_link: {e}")
-        try:
-            if update.callback_query:
-                await update.callback_query.message.reply_text("❌ An error occurred. Please try again.")
-            else:
-                await update.message.reply_text("❌ An error occurred. Please try again.")
-        except:
-            pass
+async def get_referral_link_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /get_referral_link command"""
+    await _get_referral_link_impl(update.message.reply_text, update.effective_user, context)
+
+async def get_referral_link_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Referral Contest button"""
+    query = update.callback_query
+    await _get_referral_link_impl(query.message.reply_text, query.from_user, context)
 
 # --- ENGAGEMENT TRACKING ---
 async def track_engagement(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Track user engagement in group chat"""
     try:
-        # Only track group messages
-        if update.message.chat.type not in ["group", "supergroup"]:
-            return
-
-        # Only track if it's the designated group (if set)
-        if GROUP_CHAT_ID and update.message.chat.id != GROUP_CHAT_ID:
-            return
-
+        # Chat type and group filtering is done by the handler's filters
         user_id = update.effective_user.id
         username = update.effective_user.username or f"User{user_id}"
         
         week, month = get_current_period()
 
-        # Update weekly engagement
-        cur.execute("""
-            INSERT INTO engagement (user_id, username, message_count, last_message_at, period)
-            VALUES (?, ?, 1, CURRENT_TIMESTAMP, ?)
-            ON CONFLICT(user_id, period) DO UPDATE SET
-                message_count = message_count + 1,
-                last_message_at = CURRENT_TIMESTAMP,
-                username = ?
-        """, (user_id, username, week, username))
-        
-        conn.commit()
+        # Count the message in memory; flush_engagement writes it out
+        key = (user_id, week)
+        _, count = ENG_BUFFER.get(key, (username, 0))
+        ENG_BUFFER[key] = (username, count + 1)
 
     except Exception as e:
         logger.error(f"Error tracking engagement: {e}")
 
-# --- BUTTON HANDLERS ---
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button callbacks"""
-    try:
-        query = update.callback_query
-        await query.answer()
-        
-        user_id = query.from_user.id
-        data = query.data
+async def flush_engagement(context: ContextTypes.DEFAULT_TYPE = None):
+    """Write buffered engagement counts to the database in one transaction"""
+    async with ENG_LOCK:
+        if not ENG_BUFFER:
+            return
 
-        # Ambassador task completion
-        if data.startswith("amb_done_"):
-            referrer_id = int(data.replace("amb_done_", ""))
-            cur.execute("SELECT status FROM users WHERE user_id=? AND referrer=?", (user_id, referrer_id))
-            record = cur.fetchone()
-
-            if record and record[0] != "completed":
-                cur.execute("UPDATE users SET status=? WHERE user_id=?", ("completed", user_id))
-                cur.execute("UPDATE ambassadors SET points = points + ? WHERE user_id=?", 
-                           (POINTS_PER_REFERRAL, referrer_id))
-                conn.commit()
-                logger.info(f"Ambassador referral completed: {user_id} -> {referrer_id}")
-                await query.edit_message_text(
-                    "🎉 Tasks completed! Thank you for joining!\n"
-                    "🚀 Want your own referral link? Send /get_referral_link"
-                )
-            else:
-                await query.edit_message_text("✅ Already completed!")
+        pending = dict(ENG_BUFFER)
+        ENG_BUFFER.clear()
 
-        # Referral task completion
-        elif data.startswith("ref_done_"):
-            referrer_id = int(data.replace("ref_done_", ""))
-            week, month = get_current_period()
-            
-            cur.execute("SELECT status FROM referrals WHERE user_id=? AND period=?", (user_id, month))
-            record = cur.fetchone()
-
-            if record and record[0] != "completed":
-                cur.execute("""
-                    UPDATE referrals SET status=?, completed_at=CURRENT_TIMESTAMP 
-                    WHERE user_id=? AND period=?
-                """, ("completed", user_id, month))
-                conn.commit()
-                logger.info(f"Referral completed: {user_id} -> {referrer_id}")
-                await query.edit_message_text(
-                    "🎉 Tasks completed! Your referrer gets credit!\n"
-                    "🏆 Want to compete? Send /get_referral_link"
-                )
-            else:
-                await query.edit_message_text("✅ Already completed!")
-
-        # Menu buttons
-        elif data == "become_amb":
-            await become_ambassador(update, context)
-        elif data == "get_ref":
-            await get_referral_link(update, context)
-        elif data == "my_stats":
-            await my_stats(update, context)
-        elif data == "leaderboards":
-            await show_all_leaderboards(update, context)
-
-    except Exception as e:
-        logger.error(f"Error in button: {e}")
         try:
-            await query.edit_message_text("❌ An error occurred. Please try again.")
-        except:
-            pass
+            async with write() as c:
+                await c.executemany(SQL_UPSERT_ENGAGEMENT, [
+                    (user_id, username, count, period)
+                    for (user_id, period), (username, count) in pending.items()
+                ])
+                await c.commit()
 
-# --- STATS & LEADERBOARDS ---
-async def my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show comprehensive user stats"""
-    try:
-        # Handle both message and callback query
-        if update.callback_query:
-            user_id = update.callback_query.from_user.id
-            send_method = update.callback_query.message.reply_text
-        else:
-            user_id = update.effective_user.id
-            send_method = update.message.reply_text
+        except Exception as e:
+            logger.error(f"Error flushing engagement: {e}")
+            # Put the counts back so they are retried on the next flush
+            for key, (username, count) in pending.items():
+                newer_username, newer_count = ENG_BUFFER.get(key, (username, 0))
+                ENG_BUFFER[key] = (newer_username, count + newer_count)
 
-        stats_text = "📊 **Your Statistics**\n\n"
+# --- BUTTON HANDLERS ---
+async def complete_ambassador_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle ambassador task completion button"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    referrer_id = int(query.data.replace("amb_done_", ""))
+    # Take the write lock up front so concurrent presses queue instead
+    # of failing with "database is locked"; RETURNING replaces the SELECT
+    async with write() as c:
+        await c.execute("BEGIN IMMEDIATE")
+        completed = await c.execute_fetchall(SQL_COMPLETE_USER, (user_id, referrer_id))
+        first_completion = bool(completed)
+        if first_completion:
+            await c.execute(SQL_ADD_AMBASSADOR_POINTS, (POINTS_PER_REFERRAL, completed[0][0]))
+        await c.commit()
+
+    if first_completion:
+        logger.info(f"Ambassador referral completed: {user_id} -> {referrer_id}")
+        await query.edit_message_text(
+            "🎉 Tasks completed! Thank you for joining!\n"
+            "🚀 Want your own referral link? Send /get_referral_link"
+        )
+    else:
+        await query.edit_message_text("✅ Already completed!")
 
-        # Ambassador stats
-        cur.execute("SELECT username, points FROM ambassadors WHERE user_id=?", (user_id,))
-        amb = cur.fetchone()
-        if amb:
-            cur.execute("SELECT COUNT(*) FROM users WHERE referrer=? AND status='completed'", (user_id,))
-            amb_refs = cur.fetchone()[0]
-            
-            try:
-                bot_info = await context.bot.get_me()
-                bot_username = bot_info.username
-            except:
-                bot_username = "ceruleanlabsbot"
+async def complete_referral_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle referral task completion button"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    referrer_id = int(query.data.replace("ref_done_", ""))
+    week, month = get_current_period()
             
-            amb_link = f"https://t.me/{bot_username}?start=amb_{user_id}"
-            stats_text += f"👑 **Ambassador Program**\n"
-            stats_text += f"⭐ Points: {amb[1]}\n"
-            stats_text += f"🎯 Referrals: {amb_refs}\n"
-            stats_text += f"🔗 Link: `{amb_link}`\n\n"
+    # A returned row means this press is the one that completed it
+    async with write() as c:
+        completed = await c.execute_fetchall(SQL_COMPLETE_REFERRAL, (user_id, month))
+        await c.commit()
+    first_completion = bool(completed)
+
+    if first_completion:
+        logger.info(f"Referral completed: {user_id} -> {referrer_id}")
+        await query.edit_message_text(
+            "🎉 Tasks completed! Your referrer gets credit!\n"
+            "🏆 Want to compete? Send /get_referral_link"
+        )
+    else:
+        await query.edit_message_text("✅ Already completed!")
 
-        # Referral contest stats
-        week, month = get_current_period()
-        cur.execute("""
+# --- STATS & LEADERBOARDS ---
+async def _my_stats_impl(send, user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """Show comprehensive user stats"""
+    stats_text = STATS_HEADER
+
+    week, month = get_current_period()
+    async with read() as c:
+        amb = await (await c.execute(
+            "SELECT username, points FROM ambassadors WHERE user_id=?", (user_id,)
+        )).fetchone()
+        if amb:
+            amb_refs = (await (await c.execute(
+                "SELECT COUNT(*) FROM users WHERE referrer=? AND status='completed'", (user_id,)
+            )).fetchone())[0]
+        ref_count = (await (await c.execute("""
             SELECT COUNT(*) FROM referrals 
             WHERE referrer_id=? AND status='completed' AND period=?
-        """, (user_id, month))
-        ref_count = cur.fetchone()[0]
-        
-        if ref_count > 0 or not amb:
-            try:
-                bot_info = await context.bot.get_me()
-                bot_username = bot_info.username
-            except:
-                bot_username = "ceruleanlabsbot"
+        """, (user_id, month))).fetchone())[0]
+        eng = await (await c.execute(
+            "SELECT message_count FROM engagement WHERE user_id=? AND period=?", (user_id, week)
+        )).fetchone()
+
+    # Ambassador stats
+    if amb:
+        bot_username = get_bot_username(context)
+            
+        amb_link = f"https://t.me/{bot_username}?start=amb_{user_id}"
+        stats_text += "👑 <b>Ambassador Program</b>\n"
+        stats_text += f"⭐ Points: {amb[1]}\n"
+        stats_text += f"🎯 Referrals: {amb_refs}\n"
+        stats_text += f"🔗 Link: <code>{html.escape(amb_link)}</code>\n\n"
+
+    # Referral contest stats
+    if ref_count > 0 or not amb:
+        bot_username = get_bot_username(context)
             
-            ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-            stats_text += f"🎁 **Referral Contest (This Month)**\n"
-            stats_text += f"👥 Referrals: {ref_count}\n"
-            stats_text += f"🔗 Link: `{ref_link}`\n\n"
+        ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
+        stats_text += "🎁 <b>Referral Contest (This Month)</b>\n"
+        stats_text += f"👥 Referrals: {ref_count}\n"
+        stats_text += f"🔗 Link: <code>{html.escape(ref_link)}</code>\n\n"
 
-        # Engagement stats
-        cur.execute("SELECT message_count FROM engagement WHERE user_id=? AND period=?", (user_id, week))
-        eng = cur.fetchone()
-        if eng and eng[0] > 0:
-            stats_text += f"💬 **Group Engagement (This Week)**\n"
-            stats_text += f"📨 Messages: {eng[0]}\n\n"
+    # Engagement stats
+    if eng and eng[0] > 0:
+        stats_text += "💬 <b>Group Engagement (This Week)</b>\n"
+        stats_text += f"📨 Messages: {eng[0]}\n\n"
 
-        if len(stats_text) == len("📊 **Your Statistics**\n\n"):
-            stats_text += "ℹ️ No activity yet. Get started with /start!"
+    if stats_text == STATS_HEADER:
+        stats_text += "ℹ️ No activity yet. Get started with /start!"
 
-        await send_method(stats_text, parse_mode="Markdown")
+    await send(stats_text, parse_mode=ParseMode.HTML)
 
-    except Exception as e:
-        logger.error(f"Error in my_stats: {e}")
-        try:
-            if update.callback_query:
-                await update.callback_query.message.reply_text("❌ Error loading stats.")
-            else:
-                await update.message.reply_text("❌ Error loading stats.")
-        except:
-            pass
+async def my_stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /stats command"""
+    await _my_stats_impl(update.message.reply_text, update.effective_user.id, context)
+
+async def my_stats_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle My Stats button"""
+    query = update.callback_query
+    await _my_stats_impl(query.message.reply_text, query.from_user.id, context)
 
-async def show_all_leaderboards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _show_all_leaderboards_impl(send):
     """Show all leaderboard options"""
-    keyboard = [
-        [InlineKeyboardButton("👑 Ambassador Leaderboard", callback_data="lb_amb")],
-        [InlineKeyboardButton("🎁 Referral Contest (Monthly)", callback_data="lb_ref")],
-        [InlineKeyboardButton("💬 Engagement (Weekly)", callback_data="lb_eng")]
-    ]
-    
-    text = "🏆 Choose a Leaderboard:"
-    
-    if update.callback_query:
-        await update.callback_query.message.reply_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    else:
-        await update.message.reply_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    await send("🏆 Choose a Leaderboard:", reply_markup=LEADERBOARDS_KB)
 
-async def ambassador_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show ambassador leaderboard"""
-    try:
-        cur.execute("SELECT username, points FROM ambassadors ORDER BY points DESC LIMIT 10")
-        top = cur.fetchall()
+async def show_all_leaderboards_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /leaderboards command"""
+    await _show_all_leaderboards_impl(update.message.reply_text)
 
-        if not top:
-            text = "🏆 No ambassadors yet!"
-        else:
-            text = "👑 Ambassador Leaderboard\n\n"
-            for i, (username, points) in enumerate(top, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                text += f"{medal} @{username} - {points} pts\n"
+async def show_all_leaderboards_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Leaderboards button"""
+    await _show_all_leaderboards_impl(update.callback_query.message.reply_text)
 
-        if update.callback_query:
-            await update.callback_query.message.reply_text(text)
-        else:
-            await update.message.reply_text(text)
+async def rebuild_leaderboards(context: ContextTypes.DEFAULT_TYPE = None):
+    """Recompute the top-10 of every leaderboard into leaderboard_cache"""
+    week, month = get_current_period()
+    try:
+        async with write() as c:
+            await c.execute("BEGIN IMMEDIATE")
+            await c.execute("DELETE FROM leaderboard_cache")
+
+            await c.execute("""
+                INSERT INTO leaderboard_cache (category, period, rank, username, count)
+                SELECT 'ambassador', 'all', ROW_NUMBER() OVER (ORDER BY points DESC), username, points
+                FROM ambassadors
+                ORDER BY points DESC
+                LIMIT 10
+            """)
+
+            # Aggregate once per referrer; names come from the referrer's own
+            # referral row or ambassador row, both primary-key lookups
+            await c.execute("""
+                INSERT INTO leaderboard_cache (category, period, rank, username, count)
+                SELECT 'referral', ?, ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC),
+                       COALESCE(own.username, a.username, 'User' || r.referrer_id), COUNT(*)
+                FROM referrals r
+                LEFT JOIN referrals own ON own.user_id = r.referrer_id
+                LEFT JOIN ambassadors a ON a.user_id = r.referrer_id
+                WHERE r.status='completed' AND r.period=? AND r.referrer_id IS NOT NULL
+                GROUP BY r.referrer_id
+                ORDER BY COUNT(*) DESC
+                LIMIT 10
+            """, (month, month))
+
+            await c.execute("""
+                INSERT INTO leaderboard_cache (category, period, rank, username, count)
+                SELECT 'engagement', ?, ROW_NUMBER() OVER (ORDER BY message_count DESC), username, message_count
+                FROM engagement
+                WHERE period=?
+                ORDER BY message_count DESC
+                LIMIT 10
+            """, (week, week))
+
+            await c.commit()
 
     except Exception as e:
-        logger.error(f"Error in ambassador_leaderboard: {e}")
+        logger.error(f"Error rebuilding leaderboards: {e}")
+
+async def _ambassador_leaderboard_impl(send):
+    """Show ambassador leaderboard"""
+    async with read() as c:
+        top = await c.execute_fetchall(SQL_CACHED_LEADERBOARD, ("ambassador", "all"))
+
+    if not top:
+        text = "🏆 No ambassadors yet!"
+    else:
+        text = "👑 Ambassador Leaderboard\n\n" + format_ranking(top, "pts")
+
+    await send(text)
+
+async def ambassador_leaderboard_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /ambassador_leaderboard command"""
+    await _ambassador_leaderboard_impl(update.message.reply_text)
 
-async def referral_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def ambassador_leaderboard_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Ambassadors leaderboard button"""
+    await _ambassador_leaderboard_impl(update.callback_query.message.reply_text)
+
+async def _referral_leaderboard_impl(send):
     """Show monthly referral contest leaderboard"""
-    try:
-        week, month = get_current_period()
-        cur.execute("""
-            SELECT r.username, COUNT(*) as ref_count
-            FROM referrals ref
-            JOIN referrals r ON ref.referrer_id = r.user_id
-            WHERE ref.status='completed' AND ref.period=?
-            GROUP BY ref.referrer_id
-            ORDER BY ref_count DESC
-            LIMIT 10
-        """, (month,))
-        top = cur.fetchall()
+    week, month = get_current_period()
+    async with read() as c:
+        top = await c.execute_fetchall(SQL_CACHED_LEADERBOARD, ("referral", month))
 
-        if not top:
-            text = f"🎁 Monthly Referral Contest ({month})\n\nNo referrals yet this month!"
-        else:
-            text = f"🎁 Monthly Referral Contest ({month})\n\n"
-            for i, (username, count) in enumerate(top, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                text += f"{medal} @{username} - {count} referrals\n"
+    if not top:
+        text = f"🎁 Monthly Referral Contest ({month})\n\nNo referrals yet this month!"
+    else:
+        text = f"🎁 Monthly Referral Contest ({month})\n\n" + format_ranking(top, "referrals")
 
-        if update.callback_query:
-            await update.callback_query.message.reply_text(text)
-        else:
-            await update.message.reply_text(text)
+    await send(text)
 
-    except Exception as e:
-        logger.error(f"Error in referral_leaderboard: {e}")
+async def referral_leaderboard_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /referral_leaderboard command"""
+    await _referral_leaderboard_impl(update.message.reply_text)
+
+async def referral_leaderboard_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Referral Contest leaderboard button"""
+    await _referral_leaderboard_impl(update.callback_query.message.reply_text)
 
-async def engagement_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _engagement_leaderboard_impl(send):
     """Show weekly engagement leaderboard"""
-    try:
-        week, month = get_current_period()
-        cur.execute("""
-            SELECT username, message_count 
-            FROM engagement 
-            WHERE period=? 
-            ORDER BY message_count DESC 
-            LIMIT 10
-        """, (week,))
-        top = cur.fetchall()
+    week, month = get_current_period()
+    async with read() as c:
+        top = await c.execute_fetchall(SQL_CACHED_LEADERBOARD, ("engagement", week))
 
-        if not top:
-            text = f"💬 Weekly Engagement ({week})\n\nNo activity yet this week!"
-        else:
-            text = f"💬 Weekly Engagement ({week})\n\n"
-            for i, (username, count) in enumerate(top, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                text += f"{medal} @{username} - {count} messages\n"
+    if not top:
+        text = f"💬 Weekly Engagement ({week})\n\nNo activity yet this week!"
+    else:
+        text = f"💬 Weekly Engagement ({week})\n\n" + format_ranking(top, "messages")
 
-        if update.callback_query:
-            await update.callback_query.message.reply_text(text)
-        else:
-            await update.message.reply_text(text)
+    await send(text)
 
-    except Exception as e:
-        logger.error(f"Error in engagement_leaderboard: {e}")
+async def engagement_leaderboard_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /engagement_leaderboard command"""
+    await _engagement_leaderboard_impl(update.message.reply_text)
+
+async def engagement_leaderboard_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle Engagement leaderboard button"""
+    await _engagement_leaderboard_impl(update.callback_query.message.reply_text)
 
 # --- ADMIN COMMANDS ---
 async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin report"""
-    try:
-        if update.effective_user.id not in ADMIN_IDS:
-            return
+    if update.effective_user.id not in ADMIN_IDS:
+        return
 
-        week, month = get_current_period()
+    week, month = get_current_period()
+    await flush_engagement()
         
+    async with read() as c:
         # Ambassador stats
-        cur.execute("SELECT COUNT(*), SUM(points) FROM ambassadors")
-        amb_data = cur.fetchone()
-        
+        amb_data = await (await c.execute(
+            "SELECT COUNT(*), SUM(points) FROM ambassadors"
+        )).fetchone()
+            
         # Referral contest stats
-        cur.execute("SELECT COUNT(*) FROM referrals WHERE status='completed' AND period=?", (month,))
-        ref_count = cur.fetchone()[0]
-        
+        ref_count = (await (await c.execute(
+            "SELECT COUNT(*) FROM referrals WHERE status='completed' AND period=?", (month,)
+        )).fetchone())[0]
+            
         # Engagement stats
-        cur.execute("SELECT COUNT(*), SUM(message_count) FROM engagement WHERE period=?", (week,))
-        eng_data = cur.fetchone()
-
-        text = (
-            f"📊 **Admin Report**\n\n"
-            f"👑 **Ambassadors**: {amb_data[0] or 0} total ({amb_data[1] or 0} pts)\n"
-            f"🎁 **Referrals (This Month)**: {ref_count}\n"
-            f"💬 **Engagement (This Week)**: {eng_data[0] or 0} users ({eng_data[1] or 0} msgs)\n\n"
-            f"📋 **Detailed Leaderboards:**\n"
-            f"/ambassador_leaderboard\n"
-            f"/referral_leaderboard\n"
-            f"/engagement_leaderboard\n\n"
-            f"📂 Use /export to download CSV data"
-        )
+        eng_data = await (await c.execute(
+            "SELECT COUNT(*), SUM(message_count) FROM engagement WHERE period=?", (week,)
+        )).fetchone()
+
+    text = (
+        f"📊 <b>Admin Report</b>\n\n"
+        f"👑 <b>Ambassadors</b>: {amb_data[0] or 0} total ({amb_data[1] or 0} pts)\n"
+        f"🎁 <b>Referrals (This Month)</b>: {ref_count}\n"
+        f"💬 <b>Engagement (This Week)</b>: {eng_data[0] or 0} users ({eng_data[1] or 0} msgs)\n\n"
+        f"📋 <b>Detailed Leaderboards:</b>\n"
+        f"/ambassador_leaderboard\n"
+        f"/referral_leaderboard\n"
+        f"/engagement_leaderboard\n\n"
+        f"📂 Use /export to download CSV data"
+    )
 
-        await update.message.reply_text(text, parse_mode="Markdown")
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    except Exception as e:
-        logger.error(f"Error in report: {e}")
-        try:
-            await update.message.reply_text("❌ Error generating report.")
-        except:
-            pass
+async def build_csv(header, sql):
+    """Stream a query result into an in-memory CSV file"""
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(text)
+    writer.writerow(header)
+
+    # Pull fixed-size batches so memory stays flat and each worker-thread
+    # hop carries many rows instead of aiosqlite's default 64
+    async with read() as c:
+        async with c.execute(sql) as cursor:
+            while rows := await cursor.fetchmany(EXPORT_BATCH_SIZE):
+                writer.writerows(rows)
+
+    # Detach so closing the wrapper later doesn't close the buffer
+    text.detach()
+    buf.seek(0)
+    return buf
 
 async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Export all data"""
-    try:
-        user_id = update.effective_user.id
+    user_id = update.effective_user.id
         
-        if user_id not in ADMIN_IDS:
-            await update.message.reply_text("❌ Admin only.")
-            return
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Admin only.")
+        return
 
-        await update.message.reply_text("📂 Preparing exports... This may take a moment.")
+    await update.message.reply_text("📂 Preparing exports... This may take a moment.")
+    await flush_engagement()
 
-        home_dir = Path.home()
-        timestamp = int(time.time())
-        
-        # Export ambassadors
-        filename1 = home_dir / f"ambassadors_{timestamp}.csv"
-        with open(filename1, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["User ID", "Username", "Points"])
-            cur.execute("SELECT user_id, username, points FROM ambassadors ORDER BY points DESC")
-            writer.writerows(cur.fetchall())
-        
-        with open(filename1, 'rb') as f:
-            await update.message.reply_document(f, caption="📂 Ambassadors Data")
-        
-        # Export referrals
-        week, month = get_current_period()
-        filename2 = home_dir / f"referrals_{timestamp}.csv"
-        with open(filename2, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["User ID", "Referrer ID", "Username", "Status", "Period", "Completed At"])
-            cur.execute("SELECT user_id, referrer_id, username, status, period, completed_at FROM referrals ORDER BY period DESC, completed_at DESC")
-            writer.writerows(cur.fetchall())
+    timestamp = int(time.time())
         
-        with open(filename2, 'rb') as f:
-            await update.message.reply_document(f, caption="📂 Referrals Data")
+    # Export ambassadors
+    # ORDER BY walks idx_ambassadors_points, so no sort step is needed
+    ambassadors_csv = await build_csv(
+        ["User ID", "Username", "Points"],
+        "SELECT user_id, username, points FROM ambassadors ORDER BY points DESC"
+    )
+    await update.message.reply_document(
+        ambassadors_csv, filename=f"ambassadors_{timestamp}.csv", caption="📂 Ambassadors Data"
+    )
         
-        # Export engagement
-        filename3 = home_dir / f"engagement_{timestamp}.csv"
-        with open(filename3, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(["User ID", "Username", "Messages", "Period", "Last Message"])
-            cur.execute("SELECT user_id, username, message_count, period, last_message_at FROM engagement ORDER BY period DESC, message_count DESC")
-            writer.writerows(cur.fetchall())
+    # Export referrals
+    referrals_csv = await build_csv(
+        ["User ID", "Referrer ID", "Username", "Status", "Period", "Completed At"],
+        "SELECT user_id, referrer_id, username, status, period, completed_at FROM referrals ORDER BY period DESC, completed_at DESC"
+    )
+    await update.message.reply_document(
+        referrals_csv, filename=f"referrals_{timestamp}.csv", caption="📂 Referrals Data"
+    )
         
-        with open(filename3, 'rb') as f:
-            await update.message.reply_document(f, caption="📂 Engagement Data")
-
-        # Cleanup
-        filename1.unlink(missing_ok=True)
-        filename2.unlink(missing_ok=True)
-        filename3.unlink(missing_ok=True)
-
-        await update.message.reply_text("✅ Export complete!")
+    # Export engagement
+    engagement_csv = await build_csv(
+        ["User ID", "Username", "Messages", "Period", "Last Message"],
+        "SELECT user_id, username, message_count, period, last_message_at FROM engagement ORDER BY period DESC, message_count DESC"
+    )
+    await update.message.reply_document(
+        engagement_csv, filename=f"engagement_{timestamp}.csv", caption="📂 Engagement Data"
+    )
 
-    except Exception as e:
-        logger.error(f"Error in export: {e}")
-        try:
-            await update.message.reply_text("❌ Export failed. Please try again.")
-        except:
-            pass
+    await update.message.reply_text("✅ Export complete!")
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset database (Admin only - use with caution)"""
-    try:
-        if update.effective_user.id not in ADMIN_IDS:
-            await update.message.reply_text("❌ Admin only.")
-            return
-
-        # Ask for confirmation
-        keyboard = [
-            [InlineKeyboardButton("⚠️ Yes, Reset All Data", callback_data="confirm_reset")],
-            [InlineKeyboardButton("❌ Cancel", callback_data="cancel_reset")]
-        ]
-        await update.message.reply_text(
-            "⚠️ **WARNING: This will delete ALL data!**\n\n"
-            "This includes:\n"
-            "• All ambassadors and points\n"
-            "• All referrals\n"
-            "• All engagement data\n"
-            "• All winners history\n\n"
-            "Are you sure?",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Admin only.")
+        return
 
-    except Exception as e:
-        logger.error(f"Error in reset: {e}")
+    # Ask for confirmation
+    await update.message.reply_text(
+        "⚠️ <b>WARNING: This will delete ALL data!</b>\n\n"
+        "This includes:\n"
+        "• All ambassadors and points\n"
+        "• All referrals\n"
+        "• All engagement data\n"
+        "• All winners history\n\n"
+        "Are you sure?",
+        reply_markup=RESET_CONFIRM_KB,
+        parse_mode=ParseMode.HTML
+    )
 
 async def reset_weekly_engagement(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reset weekly engagement (Admin only)"""
-    try:
-        if update.effective_user.id not in ADMIN_IDS:
-            await update.message.reply_text("❌ Admin only.")
-            return
+    global ARCHIVE_KB_CACHE
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Admin only.")
+        return
 
-        week, month = get_current_period()
-        
-        # Archive current week's data before resetting
-        cur.execute("""
-            INSERT INTO winners (category, period, user_id, username, count, reward)
-            SELECT 'engagement', period, user_id, username, message_count, 'Archived'
-            FROM engagement
-            WHERE period=?
-        """, (week,))
+    week, month = get_current_period()
+    await flush_engagement()
         
+    async with write() as c:
+        # Archive and delete under one write lock so no engagement flush
+        # can land between the copy and the delete
+        await c.execute("BEGIN IMMEDIATE")
+        await c.execute(SQL_ARCHIVE_WEEK, (week,))
+            
         # Delete current week's engagement data
-        cur.execute("DELETE FROM engagement WHERE period=?", (week,))
-        conn.commit()
+        await c.execute(SQL_DELETE_WEEK, (week,))
+        await c.commit()
+    ARCHIVE_TEXT_CACHE.pop(week, None)
+    ARCHIVE_KB_CACHE = None
+    await rebuild_leaderboards()
         
-        await update.message.reply_text(
-            f"✅ Weekly engagement reset for {week}!\n"
-            f"Data has been archived to winners table."
-        )
-        logger.info(f"Weekly engagement reset by admin {update.effective_user.id}")
-
-    except Exception as e:
-        logger.error(f"Error in reset_weekly_engagement: {e}")
-        try:
-            await update.message.reply_text("❌ Error resetting weekly engagement.")
-        except:
-            pass
+    await update.message.reply_text(
+        f"✅ Weekly engagement reset for {week}!\n"
+        f"Data has been archived to winners table."
+    )
+    logger.info(f"Weekly engagement reset by admin {update.effective_user.id}")
 
 async def view_weekly_archives(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View archived weekly engagement winners (Admin only)"""
-    try:
-        if update.effective_user.id not in ADMIN_IDS:
-            await update.message.reply_text("❌ Admin only.")
-            return
+    global ARCHIVE_KB_CACHE
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Admin only.")
+        return
 
+    if ARCHIVE_KB_CACHE is None:
         # Get all archived weeks
-        cur.execute("""
-            SELECT DISTINCT period 
-            FROM winners 
-            WHERE category='engagement' 
-            ORDER BY period DESC
-        """)
-        weeks = cur.fetchall()
+        async with read() as c:
+            weeks = await c.execute_fetchall(SQL_ARCHIVED_WEEKS)
 
         if not weeks:
             await update.message.reply_text("📂 No archived weeks yet.")
@@ -826,98 +1013,221 @@ async def view_weekly_archives(update: Update, context: ContextTypes.DEFAULT_TYP
                 f"Week {week_period}", 
                 callback_data=f"archive_{week_period}"
             )])
+        ARCHIVE_KB_CACHE = InlineKeyboardMarkup(keyboard)
 
-        await update.message.reply_text(
-            "📂 Archived Weekly Engagement\n\n"
-            "Select a week to view:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-
-    except Exception as e:
-        logger.error(f"Error in view_weekly_archives: {e}")
-        try:
-            await update.message.reply_text("❌ Error loading archives.")
-        except:
-            pass
+    await update.message.reply_text(
+        "📂 Archived Weekly Engagement\n\n"
+        "Select a week to view:",
+        reply_markup=ARCHIVE_KB_CACHE
+    )
 
 async def show_archive_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show details of archived week"""
     query = update.callback_query
-    await query.answer()
     
     if query.from_user.id not in ADMIN_IDS:
         return
     
-    try:
-        week_period = query.data.replace("archive_", "")
-        
-        cur.execute("""
-            SELECT username, count 
-            FROM winners 
-            WHERE category='engagement' AND period=?
-            ORDER BY count DESC
-            LIMIT 10
-        """, (week_period,))
-        
-        top = cur.fetchall()
-        
+    week_period = query.data.replace("archive_", "")
+
+    text = ARCHIVE_TEXT_CACHE.get(week_period)
+    if text is None:
+        async with read() as c:
+            top = await c.execute_fetchall(SQL_ARCHIVE_DETAIL, (week_period,))
+
         if not top:
             text = f"📂 No data for {week_period}"
         else:
-            text = f"📂 Archived: {week_period}\n\n"
-            for i, (username, count) in enumerate(top, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                text += f"{medal} @{username} - {count} messages\n"
-        
-        await query.edit_message_text(text)
+            text = f"📂 Archived: {week_period}\n\n" + format_ranking(top, "messages")
+        ARCHIVE_TEXT_CACHE[week_period] = text
         
-    except Exception as e:
-        logger.error(f"Error showing archive detail: {e}")
+    await query.edit_message_text(text)
 
 async def confirm_reset_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle reset confirmation"""
+    global ARCHIVE_KB_CACHE
     query = update.callback_query
-    await query.answer()
     
     if query.from_user.id not in ADMIN_IDS:
         return
     
     if query.data == "confirm_reset":
-        try:
-            cur.execute("DELETE FROM users")
-            cur.execute("DELETE FROM ambassadors")
-            cur.execute("DELETE FROM referrals")
-            cur.execute("DELETE FROM engagement")
-            cur.execute("DELETE FROM winners")
-            conn.commit()
-            
-            await query.edit_message_text("🗑 Database has been completely reset.")
-            logger.warning(f"Database reset by admin {query.from_user.id}")
-        except Exception as e:
-            logger.error(f"Error resetting database: {e}")
-            await query.edit_message_text("❌ Error resetting database.")
+        ENG_BUFFER.clear()
+        async with write() as c:
+            await c.executescript(SQL_RESET_ALL)
+        ARCHIVE_TEXT_CACHE.clear()
+        ARCHIVE_KB_CACHE = None
+        await rebuild_leaderboards()
+        
+        await query.edit_message_text("🗑 Database has been completely reset.")
+        logger.warning(f"Database reset by admin {query.from_user.id}")
     else:
         await query.edit_message_text("✅ Reset cancelled. Data is safe.")
 
+# --- CALLBACK ROUTING ---
+# One CallbackQueryHandler matches every button; the router then looks up
+# exact callback data first, then prefixed data carrying an id or period
+CALLBACK_PATTERN = _route_re.compile(
+    r"^(?:amb_done_|ref_done_|become_amb|get_ref|my_stats|leaderboards"
+    r"|lb_(?:amb|ref|eng)|confirm_reset|cancel_reset|archive_)"
+)
+
+CALLBACK_ROUTES = {
+    "become_amb": become_ambassador_cb,
+    "get_ref": get_referral_link_cb,
+    "my_stats": my_stats_cb,
+    "leaderboards": show_all_leaderboards_cb,
+    "lb_amb": ambassador_leaderboard_cb,
+    "lb_ref": referral_leaderboard_cb,
+    "lb_eng": engagement_leaderboard_cb,
+    "confirm_reset": confirm_reset_handler,
+    "cancel_reset": confirm_reset_handler,
+}
+CALLBACK_PREFIX_ROUTES = (
+    ("amb_done_", complete_ambassador_tasks),
+    ("ref_done_", complete_referral_tasks),
+    ("archive_", show_archive_detail),
+)
+
+async def answer_callback(query):
+    """Acknowledge a button press; a failed ack never fails the action"""
+    try:
+        await query.answer(cache_time=1)
+    except TelegramError as e:
+        logger.debug(f"Could not answer callback query: {e}")
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Dispatch every button press to its handler"""
+    query = update.callback_query
+    # Acknowledge concurrently with the handler's DB work instead of paying
+    # the round-trip first; cache_time lets clients absorb rapid re-clicks
+    ack = asyncio.create_task(answer_callback(query))
+    try:
+        data = query.data
+        handler = CALLBACK_ROUTES.get(data)
+        if handler is None:
+            for prefix, prefix_handler in CALLBACK_PREFIX_ROUTES:
+                if data.startswith(prefix):
+                    handler = prefix_handler
+                    break
+            else:
+                return
+        await handler(update, context)
+    finally:
+        await ack
+
+async def post_init(application: Application):
+    """Set up shared resources before polling starts"""
+    await init_database()
+
+    # Referral links only need the bot username, so fetch it once
+    try:
+        bot_info = await application.bot.get_me()
+        application.bot_data["bot_username"] = bot_info.username
+    except Exception as e:
+        logger.warning(f"Could not fetch bot username, using {DEFAULT_BOT_USERNAME}: {e}")
+
+    application.job_queue.run_repeating(
+        flush_engagement, interval=ENGAGEMENT_FLUSH_INTERVAL, name="flush_engagement"
+    )
+    application.job_queue.run_repeating(
+        rebuild_leaderboards, interval=LEADERBOARD_REFRESH_INTERVAL, first=0, name="rebuild_leaderboards"
+    )
+
+async def post_shutdown(application: Application):
+    """Release shared resources after polling stops"""
+    # Jobs outlive a shutdown; drop them so a retried run schedules fresh
+    # ones, including the immediate leaderboard rebuild
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+    await flush_engagement()
+    await close_database()
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-    """Log errors caused by updates"""
+    """Log errors caused by updates and tell the user once"""
+    # A re-tapped button editing a message to the text it already shows;
+    # the action itself worked, so there is nothing to report
+    if isinstance(context.error, BadRequest) and "not modified" in context.error.message.lower():
+        logger.debug(f"Ignoring unchanged message edit: {context.error}")
+        return
+
     logger.error(f"Exception while handling update: {context.error}", exc_info=context.error)
 
+    # Handlers let failures propagate here instead of each sending its own
+    # fallback reply; polling errors arrive without an update to answer
+    if isinstance(update, Update) and update.effective_message:
+        # The original failure may itself have been a send (blocked bot,
+        # timeout), in which case this reply fails the same way
+        try:
+            await update.effective_message.reply_text("❌ An error occurred. Please try again.")
+        except TelegramError as e:
+            logger.debug(f"Could not send error reply: {e}")
+
 def create_application():
     """Create application with custom request settings"""
+    # Outgoing API calls (replies, edits, uploads); sized above the number of
+    # sends expected to be in flight at once so bursts don't wait for a slot
     request = HTTPXRequest(
-        connection_pool_size=8,
-        connect_timeout=60.0,
-        read_timeout=60.0,
+        connection_pool_size=256,
+        connect_timeout=10.0,
+        read_timeout=20.0,
         write_timeout=60.0,
-        pool_timeout=60.0,
+        pool_timeout=20.0,
+    )
+    # getUpdates gets its own pool so long polling never holds an API slot;
+    # only one poll is in flight at a time, so a handful of connections is plenty.
+    # Its read timeout comes from run_polling, which passes one on every call
+    get_updates_request = HTTPXRequest(connection_pool_size=4)
+    return (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
     )
-    return Application.builder().token(TOKEN).request(request).build()
+
+def build_application():
+    """Create the application and register all handlers"""
+    app = create_application()
+    app.add_error_handler(error_handler)
+
+    # Command handlers
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("become_ambassador", become_ambassador_cmd))
+    app.add_handler(CommandHandler("get_referral_link", get_referral_link_cmd))
+    app.add_handler(CommandHandler("stats", my_stats_cmd))
+    app.add_handler(CommandHandler("leaderboards", show_all_leaderboards_cmd))
+    app.add_handler(CommandHandler("ambassador_leaderboard", ambassador_leaderboard_cmd))
+    app.add_handler(CommandHandler("referral_leaderboard", referral_leaderboard_cmd))
+    app.add_handler(CommandHandler("engagement_leaderboard", engagement_leaderboard_cmd))
+    app.add_handler(CommandHandler("report", report))
+    app.add_handler(CommandHandler("export", export))
+    app.add_handler(CommandHandler("reset", reset))
+    app.add_handler(CommandHandler("reset_weekly", reset_weekly_engagement))
+    app.add_handler(CommandHandler("weekly_archives", view_weekly_archives))
+
+    # Callback query handlers
+    # A callable pattern is used as-is, so re2 matching isn't routed back
+    # through the stdlib re module
+    app.add_handler(CallbackQueryHandler(route_callback, pattern=CALLBACK_PATTERN.match))
+
+    # Message handler for engagement tracking in groups; filtering here
+    # means other chats never reach the callback
+    engagement_filter = filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS
+    if GROUP_CHAT_ID:
+        engagement_filter &= filters.Chat(chat_id=GROUP_CHAT_ID)
+    app.add_handler(MessageHandler(engagement_filter, track_engagement))
+    return app
 
 def main():
     """Main function with retry logic"""
     max_retries = 5
     retry_count = 0
+    # Built once and reused by every retry; run_polling shuts the app down
+    # cleanly on failure, so it can simply be started again
+    app = None
     
     while retry_count < max_retries:
         try:
@@ -925,35 +1235,8 @@ def main():
             print("🤖 Cerulean Labs Bot Initializing...")
             print("=" * 50)
             
-            # Create application
-            app = create_application()
-            app.add_error_handler(error_handler)
-
-            # Command handlers
-            app.add_handler(CommandHandler("start", start))
-            app.add_handler(CommandHandler("become_ambassador", become_ambassador))
-            app.add_handler(CommandHandler("get_referral_link", get_referral_link))
-            app.add_handler(CommandHandler("stats", my_stats))
-            app.add_handler(CommandHandler("leaderboards", show_all_leaderboards))
-            app.add_handler(CommandHandler("ambassador_leaderboard", ambassador_leaderboard))
-            app.add_handler(CommandHandler("referral_leaderboard", referral_leaderboard))
-            app.add_handler(CommandHandler("engagement_leaderboard", engagement_leaderboard))
-            app.add_handler(CommandHandler("report", report))
-            app.add_handler(CommandHandler("export", export))
-            app.add_handler(CommandHandler("reset", reset))
-            app.add_handler(CommandHandler("reset_weekly", reset_weekly_engagement))
-            app.add_handler(CommandHandler("weekly_archives", view_weekly_archives))
-
-            # Callback query handlers
-            app.add_handler(CallbackQueryHandler(button, pattern="^(amb_done_|ref_done_|become_amb|get_ref|my_stats|leaderboards)"))
-            app.add_handler(CallbackQueryHandler(ambassador_leaderboard, pattern="^lb_amb$"))
-            app.add_handler(CallbackQueryHandler(referral_leaderboard, pattern="^lb_ref$"))
-            app.add_handler(CallbackQueryHandler(engagement_leaderboard, pattern="^lb_eng$"))
-            app.add_handler(CallbackQueryHandler(confirm_reset_handler, pattern="^(confirm_reset|cancel_reset)$"))
-            app.add_handler(CallbackQueryHandler(show_archive_detail, pattern="^archive_"))
-
-            # Message handler for engagement tracking in groups
-            app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track_engagement))
+            if app is None:
+                app = build_application()
 
             print("\n✅ Bot initialized successfully!")
             print("\n📊 Active Features:")
@@ -969,8 +1252,18 @@ def main():
             
             logger.info("Bot started successfully")
             
-            # Run the bot
-            app.run_polling(drop_pending_updates=True)
+            # Run the bot; long-poll for Telegram's 50s maximum. PTB adds
+            # read_timeout on top of timeout, so the HTTP read waits 60s and
+            # never aborts before the server answers an idle poll. The event
+            # loop is kept open so a retry can run on it again
+            app.run_polling(
+                drop_pending_updates=True,
+                timeout=50,
+                read_timeout=10,
+                poll_interval=0.0,
+                bootstrap_retries=5,
+                close_loop=False,
+            )
             
             # If we reach here, bot stopped normally
             break
@@ -982,8 +1275,11 @@ def main():
             print(f"Error: {e}")
             
             if retry_count < max_retries:
-                print(f"🔄 Retrying in 10 seconds...\n")
-                time.sleep(10)
+                # Exponential backoff with jitter: quick first retry for
+                # transient blips, spread out when failures persist
+                delay = min(60, 2 ** retry_count) + random.uniform(0, 1)
+                print(f"🔄 Retrying in {delay:.1f} seconds...\n")
+                time.sleep(delay)
             else:
                 print("\n❌ Max retries reached.")
                 print("Please check:")